@@ -8,22 +8,35 @@ In addition to the frame-specific information it also provides information on ea
 such as the transcript ID, camera, and resolution used for the OpenPose output.
 This script takes a set of one-frame-per-file input files and applies the wrapper to them.
 """
-from __future__ import print_function
 import argparse
 import os
 import re
 import json
-from collections import OrderedDict
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 from glob import glob
 from warnings import warn
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-KEYPOINTS_KEY_VALUE_RE = r'("[\w_]+?_keypoints_\dd": \[)([\n\d., -e]+?)(])'
 
-FILENAME_TEMPL = r'^(?:.+/)*(?P<id>.+)_(?P<camera>.+){}(?P<width>\d+)x(?P<height>\d+){}(?P<frame>\d+){}keypoints\.json$'
-FILENAME_EXTRACTOR_RE = FILENAME_TEMPL.format(r'\.', r'\.frame_', r'\.')
-FILENAME_OPFILE_RE = FILENAME_TEMPL.format('_', '_', '_')
-FILENAME_OPDIR_RE = FILENAME_TEMPL.format('_', '/.*_', '_')
+GLOB_MAGIC_RE = re.compile(r'[*?[]')
+
+KEYPOINTS_KEY_SUFFIXES = ('_keypoints_2d', '_keypoints_3d')
+JSON_INDENT = 2
+
+FILENAME_TEMPL = r'(?:.*/)?(?P<id>[^/]+)_(?P<camera>[^/]+){}(?P<width>\d+)x(?P<height>\d+){}(?P<frame>\d+){}keypoints\.json'
+FILENAME_EXTRACTOR_RE = re.compile(FILENAME_TEMPL.format(r'\.', r'\.frame_', r'\.'))
+FILENAME_OPFILE_RE = re.compile(FILENAME_TEMPL.format('_', '_', '_'))
+FILENAME_OPDIR_RE = re.compile(FILENAME_TEMPL.format('_', '/(?:.*/)?[^/]*_', '_'))
+FILENAME_PRESET_RES = (FILENAME_EXTRACTOR_RE, FILENAME_OPFILE_RE, FILENAME_OPDIR_RE)  # Matched against full filenames
+FILENAME_OPFILE_SUFFIX = '_keypoints.json'
+
+MAX_LOAD_THREADS = 32
 
 
 # Auxiliary functions
@@ -39,18 +52,80 @@ def ensure_dir(filename):
             pass
 
 
-def deindent_key_value(match):
+def iter_input_files(input_batches):
+    """
+    Yield the files matched by a list of filenames or glob patterns.
+    Patterns whose wildcards are restricted to the final path component are resolved with a single os.scandir() pass
+    over their directory; all other patterns are passed on to glob().
+    """
+    for input_batch in input_batches:
+        dirname, pattern = os.path.split(input_batch)
+        if GLOB_MAGIC_RE.search(dirname) or not GLOB_MAGIC_RE.search(pattern):
+            yield from glob(input_batch)
+        else:
+            try:
+                with os.scandir(dirname or os.curdir) as entries:
+                    for entry in entries:
+                        # Like glob(), only match hidden files if the pattern explicitly asks for them
+                        if entry.name.startswith('.') and not pattern.startswith('.'):
+                            continue
+                        if fnmatch(entry.name, pattern) and entry.is_file():
+                            yield os.path.join(dirname, entry.name)
+            except OSError:
+                pass
+
+
+def load_frame_file(filename):
     """
-    To be called by the regular expression substitution that de-indents OpenPose keypoint lists.
-    Given a fully indented json file, the substitution command should be:
-    json_output, subs = KEYPOINTS_KEY_VALUE_RE.sub(_deindent_key_value, json_indented)
+    Load the OpenPose output dict of a single frame file.
+    Uses orjson for parsing if it is installed. Files that orjson rejects (e.g. because they contain NaN values)
+    are parsed with the json module instead.
     """
-    key_string = match.group(1)
-    array_content_string = match.group(2)
-    array_close_string = match.group(3)
-    deindented_content_items = [item.strip() for item in array_content_string.split('\n')]
-    deindented_content_string = ' '.join(deindented_content_items).strip()
-    return '{}{}{}'.format(key_string, deindented_content_string, array_close_string)
+    with open(filename, 'rb', buffering=0) as f:  # The file is read in one go, so skip the buffered reader
+        content = f.read()
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(content)
+
+
+def iterencode_wrapper(obj, indent_level=0):
+    """
+    Incrementally encode wrapper data as indented JSON, yielding the output string chunk by chunk.
+    The values of OpenPose keypoint keys (see KEYPOINTS_KEY_SUFFIXES) are not indented but kept on a single line.
+    :param obj: The JSON-serializable object to encode.
+    :param indent_level: The indentation level of the object within the overall JSON structure.
+    """
+    if isinstance(obj, dict):
+        if not obj:
+            yield '{}'
+            return
+        item_indent = '\n' + ' ' * (JSON_INDENT * (indent_level + 1))
+        separator = '{'
+        for key, value in obj.items():
+            key = str(key)
+            yield '{}{}{}: '.format(separator, item_indent, json.dumps(key))
+            if key.endswith(KEYPOINTS_KEY_SUFFIXES):
+                yield json.dumps(value)
+            else:
+                yield from iterencode_wrapper(value, indent_level + 1)
+            separator = ','
+        yield '\n' + ' ' * (JSON_INDENT * indent_level) + '}'
+    elif isinstance(obj, (list, tuple)):
+        if not obj:
+            yield '[]'
+            return
+        item_indent = '\n' + ' ' * (JSON_INDENT * (indent_level + 1))
+        separator = '['
+        for value in obj:
+            yield separator + item_indent
+            yield from iterencode_wrapper(value, indent_level + 1)
+            separator = ','
+        yield '\n' + ' ' * (JSON_INDENT * indent_level) + ']'
+    else:
+        yield json.dumps(obj)
 
 
 # Core functions
@@ -59,32 +134,39 @@ def extract_regex_group_fields(regex_match):
     Extract the values from the named groups "id", "camera" "width", "height" and "frame".
     Allows for missing groups. If any of the groups were not matched, their value returns as None.
     """
-    try:
-        session_id = regex_match.group('id')
-    except IndexError:
-        session_id = None
+    fields = regex_match.groupdict()
+    session_id = fields.get('id')
+    camera = fields.get('camera')
+    width = fields.get('width')
+    height = fields.get('height')
+    frame = fields.get('frame')
 
-    try:
-        camera = regex_match.group('camera')
-    except IndexError:
-        camera = None
+    width = int(width) if width is not None else None
+    height = int(height) if height is not None else None
+    frame = int(frame) if frame is not None else None
 
-    try:
-        width = int(regex_match.group('width'))
-    except IndexError:
-        width = None
+    return session_id, camera, width, height, frame
 
-    try:
-        height = int(regex_match.group('height'))
-    except IndexError:
-        height = None
 
-    try:
-        frame = int(regex_match.group('frame'))
-    except IndexError:
-        frame = None
+def parse_opfile_filename(filename):
+    """
+    Extract session ID, camera, width, height and frame from a filename following the default pattern
+    (see FILENAME_OPFILE_RE) using plain string operations instead of the regex.
+    Returns None if the filename cannot be parsed this way.
+    """
+    basename = filename.rpartition('/')[2]
+    if not basename.endswith(FILENAME_OPFILE_SUFFIX):
+        return None
+    parts = basename[:-len(FILENAME_OPFILE_SUFFIX)].rsplit('_', 3)
+    if len(parts) != 4:
+        return None
 
-    return session_id, camera, width, height, frame
+    session_id, camera, resolution, frame = parts
+    width, _, height = resolution.partition('x')
+    if not (session_id and camera and width.isdecimal() and height.isdecimal() and frame.isdecimal()):
+        return None
+
+    return session_id, camera, int(width), int(height), int(frame)
 
 
 def group_files(filenames,
@@ -92,62 +174,68 @@ def group_files(filenames,
                 verbose=False):
     """
     Group all filenames by their session ID, camera (aka recording), resolution (i.e. width x height) and frame index.
-    :param filenames: List of filenames to be grouped together.
-    :param filename_re: Regex string with named groups used to extract metadata (see extract_regex_group_fields()).
+    :param filenames: Iterable of filenames to be grouped together.
+    :param filename_re: Compiled regex or regex string with named groups used to extract metadata
+                        (see extract_regex_group_fields()). The preset patterns have to match the full filename,
+                        custom patterns are searched for anywhere in it.
     :param verbose: If true, print script progress information.
-    :return: Dict mapping session ID -> camera -> (width, height) -> [frame, filename]
+    :return: Dict mapping session ID -> camera -> (width, height) -> frame -> filename
     """
-    id2cam2res2frame_file_tuples = {}
-    frame_file_lists = []  # A flat representation of the (frame, file)-tuple lists; used in the later sorting step.
+    if isinstance(filename_re, str):
+        filename_re = re.compile(filename_re)
+
+    use_opfile_parser = filename_re is FILENAME_OPFILE_RE  # The default pattern can be parsed without the regex
+    match_filename = filename_re.fullmatch if filename_re in FILENAME_PRESET_RES else filename_re.search
+
+    id2cam2res2frame2filename = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
+    num_files = 0
     for filename in filenames:
-        if os.path.isfile(filename):
-            filename_match = re.search(filename_re, filename)
+        fields = parse_opfile_filename(filename) if use_opfile_parser else None
+        if fields is None:
+            filename_match = match_filename(filename)
             if filename_match:
-                session_id, camera, width, height, frame = extract_regex_group_fields(filename_match)
-                resolution = (width, height)
+                fields = extract_regex_group_fields(filename_match)
 
-                cam2res2frame_file_tuples = id2cam2res2frame_file_tuples.setdefault(session_id, {})
-                res2frame_file_tuples = cam2res2frame_file_tuples.setdefault(camera, {})
-                if resolution not in res2frame_file_tuples:
-                    frame_file_tuples = []
-                    res2frame_file_tuples[resolution] = frame_file_tuples
-                    frame_file_lists.append(frame_file_tuples)
-                else:
-                    frame_file_tuples = res2frame_file_tuples[resolution]
+        if fields is not None:
+            if os.path.isfile(filename):  # Only stat matching names; glob patterns may also match directories.
+                session_id, camera, width, height, frame = fields
+                resolution = (width, height)
 
-                if frame in frame_file_tuples:
+                frame2filename = id2cam2res2frame2filename[session_id][camera][resolution]
+                if frame not in frame2filename:
+                    frame2filename[frame] = filename
+                    num_files += 1
+                elif frame2filename[frame] != filename:
                     raise ValueError('Multiple files match the same recording frame: "{}" vs "{}"'.format(
-                        filename, frame_file_tuples[frame]))
-                else:
-                    frame_file_tuples.append((frame, filename))
+                        filename, frame2filename[frame]))
 
-            elif verbose:
-                print("Ignored file not matching filename pattern: {}".format(filename))
+        elif verbose:
+            print("Ignored file not matching filename pattern: {}".format(filename))
 
-    # Sort lists by frame index
-    for frame_file_tuples in frame_file_lists:
-        frame_file_tuples.sort()
+    if verbose:
+        print('Preparing to wrap {} OpenPose frame files.'.format(num_files))
 
-    return id2cam2res2frame_file_tuples
+    return id2cam2res2frame2filename
 
 
-def sanity_check_groups(id2cam2res2frame_file_tuples):
+def sanity_check_groups(id2cam2res2frame2filename):
     """
     Print warning if there is a recording (camera of a session) with multiple possible resolutions.
-    :param id2cam2res2frame_file_tuples: A session dict as it is returned by group_files()
+    :param id2cam2res2frame2filename: A session dict as it is returned by group_files()
     """
-    for session_id, cam2res2frame_file_tuples in id2cam2res2frame_file_tuples.items():
-        for camera, res2frame_file_tuples in cam2res2frame_file_tuples.items():
-            if len(res2frame_file_tuples) > 1:
-                resolutions = ['{}x{}'.format(h, w) for h, w in res2frame_file_tuples]
+    for session_id, cam2res2frame2filename in id2cam2res2frame2filename.items():
+        for camera, res2frame2filename in cam2res2frame2filename.items():
+            if len(res2frame2filename) > 1:
+                resolutions = ['{}x{}'.format(width, height) for width, height in res2frame2filename]
                 warn('Encountered multiple resolutions for recording "{}" of session "{}": {}'.format(
                     camera, session_id, ', '.join(resolutions)))
 
 
-def load_recording(frame_file_tuples, session_id=None, camera=None, width=None, height=None, verbose=False):
+def load_recording(frame2filename, session_id=None, camera=None, width=None, height=None, verbose=False):
     """
     Load all frames of a single recording and return the dict representation of the recording.
-    :param frame_file_tuples: List of (frame index, filename) tuples. Files are loaded in frame order.
+    :param frame2filename: Dict mapping frame indices to filenames. Files are loaded concurrently and stored in
+                           frame order.
     :param session_id: The identifier of this multi-camera recording session.
     :param camera: The identifier of this specific recording (i.e. camera angle) within the session.
     :param width: An integer representing the pixel width of the video file with which the OpenPose data was computed.
@@ -156,10 +244,10 @@ def load_recording(frame_file_tuples, session_id=None, camera=None, width=None,
     :return:
     """
     if verbose:
-        print('Loading {} frames for recording "{}" of session "{}"'.format(len(frame_file_tuples), camera, session_id))
+        print('Loading {} frames for recording "{}" of session "{}"'.format(len(frame2filename), camera, session_id))
 
     # Set up recording dictionary
-    recording_dict = OrderedDict()
+    recording_dict = {}
     if session_id is not None:
         recording_dict['id'] = str(session_id)
     if camera is not None:
@@ -170,10 +258,9 @@ def load_recording(frame_file_tuples, session_id=None, camera=None, width=None,
         recording_dict['height'] = int(height)
 
     # Load frame data
-    recording_dict['frames'] = frame2data = OrderedDict()
-    for frame, filename in sorted(frame_file_tuples):
-        with open(filename) as f:
-            frame2data[frame] = json.load(f, object_pairs_hook=OrderedDict)
+    frames, filenames = zip(*sorted(frame2filename.items())) if frame2filename else ((), ())
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_LOAD_THREADS, len(filenames)))) as executor:
+        recording_dict['frames'] = dict(zip(frames, executor.map(load_frame_file, filenames)))
 
     return recording_dict
 
@@ -183,20 +270,34 @@ def write_wrapper(filename, recordings, verbose=False):
     Write wrapped OpenPose data to file.
     Applies special indentation rules to prevent keypoint lists from being indented.
 
-    :param filename: The filename of the output file
-    :param recordings: A list of recording dicts. Each recording dict contains metadata as well as the key "frames"
-                       which maps to another dict that maps frame indices to OpenPose output dict of that frame.
+    :param filename: The filename of the output file. Its directory has to exist already (see ensure_dir()).
+    :param recordings: An iterable of recording dicts. Each recording dict contains metadata as well as the key
+                       "frames" which maps to another dict that maps frame indices to OpenPose output dict of that
+                       frame. Recordings are written one at a time, so a generator only needs to hold a single
+                       recording in memory. The data is written to a temporary file next to the output file,
+                       which only replaces the output file once all recordings have been written.
     :param verbose: If true, print script progress information.
     """
     if verbose:
         print('Write wrapper file: {}'.format(filename))
 
-    ensure_dir(filename)
-    fullindent_json = json.dumps(recordings, sort_keys=False, indent=2)
-    slimindent_json = re.sub(KEYPOINTS_KEY_VALUE_RE, deindent_key_value, fullindent_json, flags=re.DOTALL)
-
-    with open(filename, 'w') as w:
-        w.write(slimindent_json)
+    temp_filename = filename + '.tmp'
+    try:
+        with open(temp_filename, 'w') as w:
+            separator = '['
+            for recording in recordings:
+                w.write(separator + '\n' + ' ' * JSON_INDENT)
+                w.writelines(iterencode_wrapper(recording, indent_level=1))
+                separator = ','
+                del recording  # Release the recording before the next one is loaded
+            w.write('[]' if separator == '[' else '\n]')
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except os.error:
+            pass
+        raise
 
 
 def batch_wrap_json_frames(input_batches, output_dir=None, filename_re=FILENAME_OPFILE_RE, verbose=False):
@@ -205,19 +306,12 @@ def batch_wrap_json_frames(input_batches, output_dir=None, filename_re=FILENAME_
     DGS-Korpus OpenPose wrapper files.
     :param input_batches: A list of filenames or glob patterns.
     :param output_dir: The directory in which to store
-    :param filename_re: Regex string with named groups used to extract metadata (see extract_regex_group_fields()).
+    :param filename_re: Compiled regex or regex string with named groups used to extract metadata
+                        (see extract_regex_group_fields()).
     :param verbose: If true, print script progress information.
     :return:
     """
-    input_files = []
-    for input_batch in input_batches:
-        for input_file in glob(input_batch):
-            input_files.append(input_file)
-
-    if verbose:
-        print('Preparing to wrap {} OpenPose frame files.'.format(len(input_files)))
-
-    input_files.sort()
+    input_files = iter_input_files(input_batches)
     wrap_json_frames(input_filenames=input_files, output_dir=output_dir, filename_re=filename_re, verbose=verbose)
 
     if verbose:
@@ -247,34 +341,38 @@ def wrap_json_frames(input_filenames, output_dir=None, filename_re=FILENAME_OPFI
     If the given filename regex allows for missing session IDs (by omitting the `id` group or making it optional),
     the filename defaults to "session.openpose.json.
 
-    :param input_filenames: List of all files to be wrapped.
+    :param input_filenames: Iterable of all files to be wrapped.
     :param output_dir: The directory in which to store
-    :param filename_re: Regex string with named groups used to extract metadata (see extract_regex_group_fields()).
+    :param filename_re: Compiled regex or regex string with named groups used to extract metadata
+                        (see extract_regex_group_fields()).
     :param verbose: If true, print script progress information.
     """
-    id2cam2res2frame_file_tuples = group_files(filenames=input_filenames, filename_re=filename_re,
-                                               verbose=verbose)
-    sanity_check_groups(id2cam2res2frame_file_tuples)
+    id2cam2res2frame2filename = group_files(filenames=input_filenames, filename_re=filename_re,
+                                            verbose=verbose)
+    sanity_check_groups(id2cam2res2frame2filename)
 
-    for session_id, cam2res2frame_file_tuples in id2cam2res2frame_file_tuples.items():
+    output_dirnames = set()  # Output directories that have already been created
+    for session_id, cam2res2frame2filename in id2cam2res2frame2filename.items():
         if verbose:
-            print('Processing cameras for session "{}": {}'.format(session_id, ', '.join(cam2res2frame_file_tuples)))
+            print('Processing cameras for session "{}": {}'.format(session_id,
+                                                                   ', '.join(sorted(cam2res2frame2filename))))
 
-        recordings = []
-        # Load recordings of this session
-        for camera in sorted(cam2res2frame_file_tuples):
-            res2frame_file_tuples = cam2res2frame_file_tuples[camera]
-            for (width, height), frame_file_tuples in res2frame_file_tuples.items():
-                recording = load_recording(frame_file_tuples=frame_file_tuples, session_id=session_id, camera=camera,
-                                           width=width, height=height, verbose=verbose)
-                recordings.append(recording)
+        # Load recordings of this session lazily, while they are being written.
+        # Resolutions of a camera are ordered by their first filename, i.e. in order of the sorted input files.
+        recordings = (load_recording(frame2filename=frame2filename, session_id=session_id, camera=camera,
+                                     width=width, height=height, verbose=verbose)
+                      for camera in sorted(cam2res2frame2filename)
+                      for (width, height), frame2filename in sorted(cam2res2frame2filename[camera].items(),
+                                                                    key=lambda item: min(item[1].values())))
 
         # Determine name of output file
-        if session_id is None:
-            session_id = 'session'
-        output_filename = '{}.openpose.json'.format(session_id)
+        output_filename = '{}.openpose.json'.format(session_id if session_id is not None else 'session')
         if output_dir is not None:
             output_filename = os.path.join(output_dir, output_filename)
+        output_dirname = os.path.dirname(output_filename)
+        if output_dirname not in output_dirnames:
+            ensure_dir(output_filename)
+            output_dirnames.add(output_dirname)
 
         # Write wrapped data of session to file
         write_wrapper(filename=output_filename, recordings=recordings, verbose=verbose)
@@ -306,7 +404,7 @@ def main():
     args = parser.parse_args()
 
     if args.regex:
-        filename_re = args.regex
+        filename_re = re.compile(args.regex)
     else:
         filename_re = key2pattern[args.preset]
 